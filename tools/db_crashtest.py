@@ -17,8 +17,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import argparse
 
+import collections
+import concurrent.futures
+import functools
 import os
 import random
+import re
 import shutil
 import signal
 import subprocess
@@ -55,32 +59,35 @@ supplied_ops = {
     "customopspercent": -1,
 }
 
+# The choices passed to `random.choice()` by the lambdas below are tuples, so
+# they are built once as constants instead of on every call. Skewed choices
+# use `random.choices()` with weights rather than repeating values.
+_COMPRESSION_TYPES = ("none", "snappy", "zlib", "lz4", "lz4hc", "xpress", "zstd")
+
 default_params = {
     "acquire_snapshot_one_in": 10000,
     "backup_max_size": 100 * 1024 * 1024,
     # Consider larger number when backups considered more stable
     "backup_one_in": 100000,
-    "batch_protection_bytes_per_key": lambda: random.choice([0, 8]),
-    "memtable_protection_bytes_per_key": lambda: random.choice([0, 1, 2, 4, 8]),
+    "batch_protection_bytes_per_key": lambda: random.choice((0, 8)),
+    "memtable_protection_bytes_per_key": lambda: random.choice((0, 1, 2, 4, 8)),
     "block_size": random.choice([16384, 4096]),
     "bloom_bits": lambda: random.choice(
         [random.randint(0, 19), random.lognormvariate(2.3, 1.3)]
     ),
     "cache_index_and_filter_blocks": lambda: random.randint(0, 1),
     "cache_size": 8388608,
-    "charge_compression_dictionary_building_buffer": lambda: random.choice([0, 1]),
-    "charge_filter_construction": lambda: random.choice([0, 1]),
-    "charge_table_reader": lambda: random.choice([0, 1]),
-    "charge_file_metadata": lambda: random.choice([0, 1]),
+    "charge_compression_dictionary_building_buffer": lambda: random.choice((0, 1)),
+    "charge_filter_construction": lambda: random.choice((0, 1)),
+    "charge_table_reader": lambda: random.choice((0, 1)),
+    "charge_file_metadata": lambda: random.choice((0, 1)),
     "checkpoint_one_in": 1000000,
-    "compression_type": lambda: random.choice(
-        ["none", "snappy", "zlib", "lz4", "lz4hc", "xpress", "zstd"]
-    ),
+    "compression_type": lambda: random.choice(_COMPRESSION_TYPES),
     "bottommost_compression_type": lambda: "disable"
-    if random.randint(0, 1) == 0
-    else random.choice(["none", "snappy", "zlib", "lz4", "lz4hc", "xpress", "zstd"]),
+    if not random.getrandbits(1)
+    else random.choice(_COMPRESSION_TYPES),
     "checksum_type": lambda: random.choice(
-        ["kCRC32c", "kxxHash", "kxxHash64", "kXXH3"]
+        ("kCRC32c", "kxxHash", "kxxHash64", "kXXH3")
     ),
     "compression_max_dict_bytes": lambda: 16384 * random.randint(0, 1),
     "compression_zstd_max_train_bytes": lambda: 65536 * random.randint(0, 1),
@@ -93,22 +100,24 @@ default_params = {
     "compact_files_one_in": 1000000,
     "compact_range_one_in": 1000000,
     "compaction_pri": random.randint(0, 4),
-    "data_block_index_type": lambda: random.choice([0, 1]),
+    "data_block_index_type": lambda: random.choice((0, 1)),
     "destroy_db_initially": 0,
-    "enable_pipelined_write": lambda: random.choice([0, 0, 0, 0, 1]),
-    "enable_compaction_filter": lambda: random.choice([0, 0, 0, 1]),
+    "enable_pipelined_write": lambda: random.choices((0, 1), weights=(4, 1))[0],
+    "enable_compaction_filter": lambda: random.choices((0, 1), weights=(3, 1))[0],
     "expected_values_dir": lambda: setup_expected_values_dir(),
     "fail_if_options_file_error": lambda: random.randint(0, 1),
     "flush_one_in": 1000000,
-    "manual_wal_flush_one_in": lambda: random.choice([0, 0, 1000, 1000000]),
-    "file_checksum_impl": lambda: random.choice(["none", "crc32c", "xxh64", "big"]),
+    "manual_wal_flush_one_in": lambda: random.choices(
+        (0, 1000, 1000000), weights=(2, 1, 1)
+    )[0],
+    "file_checksum_impl": lambda: random.choice(("none", "crc32c", "xxh64", "big")),
     "get_live_files_one_in": 100000,
     # Note: the following two are intentionally disabled as the corresponding
     # APIs are not guaranteed to succeed.
     "get_sorted_wal_files_one_in": 0,
     "get_current_wal_file_one_in": 0,
     # Temporarily disable hash index
-    "index_type": lambda: random.choice([0, 0, 0, 2, 2, 3]),
+    "index_type": lambda: random.choices((0, 2, 3), weights=(3, 2, 1))[0],
     "ingest_external_file_one_in": 1000000,
     "lock_wal_one_in": 1000000,
     "mark_for_compaction_one_file_in": lambda: 10 * random.randint(0, 1),
@@ -121,69 +130,72 @@ default_params = {
     # the random seed between runs, so the same keys are chosen by every run 
     # for disallowing overwrites.
     "nooverwritepercent": random.choice([0, 5, 20, 30, 40, 50, 95]),
-    "open_files": lambda: random.choice([-1, -1, 100, 500000]),
+    "open_files": lambda: random.choices((-1, 100, 500000), weights=(2, 1, 1))[0],
     "optimize_filters_for_memory": lambda: random.randint(0, 1),
     "partition_filters": lambda: random.randint(0, 1),
     "partition_pinning": lambda: random.randint(0, 3),
     "pause_background_one_in": 1000000,
-    "prefix_size": lambda: random.choice([-1, 1, 5, 7, 8]),
+    "prefix_size": lambda: random.choice((-1, 1, 5, 7, 8)),
     "progress_reports": 0,
     "recycle_log_file_num": lambda: random.randint(0, 1),
     "snapshot_hold_ops": 100000,
-    "sst_file_manager_bytes_per_sec": lambda: random.choice([0, 104857600]),
-    "sst_file_manager_bytes_per_truncate": lambda: random.choice([0, 1048576]),
+    "sst_file_manager_bytes_per_sec": lambda: random.choice((0, 104857600)),
+    "sst_file_manager_bytes_per_truncate": lambda: random.choice((0, 1048576)),
     "long_running_snapshots": lambda: random.randint(0, 1),
     "subcompactions": lambda: random.randint(1, 4),
     "target_file_size_base": 2097152,
     "target_file_size_multiplier": 2,
-    "test_batches_snapshots": random.choice([0, 0, 0, 1]),
+    "test_batches_snapshots": random.choices((0, 1), weights=(3, 1))[0],
     "top_level_index_pinning": lambda: random.randint(0, 3),
     "unpartitioned_pinning": lambda: random.randint(0, 3),
     "use_direct_reads": lambda: random.randint(0, 1),
     "use_direct_io_for_flush_and_compaction": lambda: random.randint(0, 1),
     "mock_direct_io": False,
-    "cache_type": lambda: random.choice(["lru_cache", "hyper_clock_cache"]),
+    "cache_type": lambda: random.choice(("lru_cache", "hyper_clock_cache")),
     "use_full_merge_v1": lambda: random.randrange(10) == 0,
     "use_merge": lambda: random.randint(0, 1),
     # use_put_entity_one_in has to be the same across invocations for verification to work, hence no lambda
-    "use_put_entity_one_in": random.choice([0] * 7 + [1, 5, 10]),
+    "use_put_entity_one_in": random.choices((0, 1, 5, 10), weights=(7, 1, 1, 1))[0],
     # 999 -> use Bloom API
     "ribbon_starting_level": lambda: random.choice([random.randint(-1, 10), 999]),
     "value_size_mult": 32,
     "verify_checksum": 1,
     "write_buffer_size": lambda: random.choice(
-        [1024 * 1024, 8 * 1024 * 1024, 128 * 1024 * 1024, 1024 * 1024 * 1024]),
-    "format_version": lambda: random.choice([2, 3, 4, 5, 5, 5, 5, 5, 5]),
-    "index_block_restart_interval": lambda: random.choice(range(1, 16)),
+        (1024 * 1024, 8 * 1024 * 1024, 128 * 1024 * 1024, 1024 * 1024 * 1024)),
+    "format_version": lambda: random.choices((2, 3, 4, 5), weights=(1, 1, 1, 6))[0],
+    "index_block_restart_interval": lambda: random.randint(1, 15),
     "use_multiget": lambda: random.randint(0, 1),
-    "use_get_entity": lambda: random.choice([0] * 7 + [1]),
-    "periodic_compaction_seconds": lambda: random.choice([0, 0, 1, 2, 10, 100, 1000]),
+    "use_get_entity": lambda: random.choices((0, 1), weights=(7, 1))[0],
+    "periodic_compaction_seconds": lambda: random.choices(
+        (0, 1, 2, 10, 100, 1000), weights=(2, 1, 1, 1, 1, 1)
+    )[0],
     # 0 = never (used by some), 10 = often (for threading bugs), 600 = default
-    "stats_dump_period_sec": lambda: random.choice([0, 10, 600]),
-    "compaction_ttl": lambda: random.choice([0, 0, 1, 2, 10, 100, 1000]),
+    "stats_dump_period_sec": lambda: random.choice((0, 10, 600)),
+    "compaction_ttl": lambda: random.choices(
+        (0, 1, 2, 10, 100, 1000), weights=(2, 1, 1, 1, 1, 1)
+    )[0],
     "fifo_allow_compaction": lambda: random.randint(0, 1),
     # Test small max_manifest_file_size in a smaller chance, as most of the
     # time we wnat manifest history to be preserved to help debug
-    "max_manifest_file_size": lambda: random.choice(
-        [t * 16384 if t < 3 else 1024 * 1024 * 1024 for t in range(1, 30)]
-    ),
+    "max_manifest_file_size": lambda: random.choices(
+        (16384, 2 * 16384, 1024 * 1024 * 1024), weights=(1, 1, 27)
+    )[0],
     # Sync mode might make test runs slower so running it in a smaller chance
-    "sync": lambda: random.choice([1 if t == 0 else 0 for t in range(0, 20)]),
-    "bytes_per_sync": lambda: random.choice([0, 262144]),
-    "wal_bytes_per_sync": lambda: random.choice([0, 524288]),
+    "sync": lambda: random.choices((0, 1), weights=(19, 1))[0],
+    "bytes_per_sync": lambda: random.choice((0, 262144)),
+    "wal_bytes_per_sync": lambda: random.choice((0, 524288)),
     # Disable compaction_readahead_size because the test is not passing.
     # "compaction_readahead_size" : lambda : random.choice(
     #    [0, 0, 1024 * 1024]),
-    "db_write_buffer_size" : lambda: random.choice(
-        [0, 0, 0, 1024 * 1024, 8 * 1024 * 1024, 128 * 1024 * 1024, 1024 * 1024 * 1024]),
-    "initiate_wbm_flushes" : lambda: random.choice([0, 1]),
+    "db_write_buffer_size" : lambda: random.choices(
+        (0, 1024 * 1024, 8 * 1024 * 1024, 128 * 1024 * 1024, 1024 * 1024 * 1024),
+        weights=(3, 1, 1, 1, 1))[0],
+    "initiate_wbm_flushes" : lambda: random.choice((0, 1)),
     "avoid_unnecessary_blocking_io": random.randint(0, 1),
     "write_dbid_to_manifest": random.randint(0, 1),
-    "avoid_flush_during_recovery": lambda: random.choice(
-        [1 if t == 0 else 0 for t in range(0, 8)]
-    ),
+    "avoid_flush_during_recovery": lambda: random.choices((0, 1), weights=(7, 1))[0],
     "max_write_batch_group_size_bytes": lambda: random.choice(
-        [16, 64, 1024 * 1024, 16 * 1024 * 1024]
+        (16, 64, 1024 * 1024, 16 * 1024 * 1024)
     ),
     "level_compaction_dynamic_level_bytes": True,
     "verify_checksum_one_in": 1000000,
@@ -191,53 +203,53 @@ default_params = {
     "continuous_verification_interval": 0,
     "max_key_len": 0,
     "key_len_percent_dist": "0",
-    "read_fault_one_in": lambda: random.choice([0, 32, 1000]),
-    "open_metadata_write_fault_one_in": lambda: random.choice([0, 0, 8]),
-    "open_write_fault_one_in": lambda: random.choice([0, 0, 16]),
-    "open_read_fault_one_in": lambda: random.choice([0, 0, 32]),
+    "read_fault_one_in": lambda: random.choice((0, 32, 1000)),
+    "open_metadata_write_fault_one_in": lambda: random.choices((0, 8), weights=(2, 1))[0],
+    "open_write_fault_one_in": lambda: random.choices((0, 16), weights=(2, 1))[0],
+    "open_read_fault_one_in": lambda: random.choices((0, 32), weights=(2, 1))[0],
     "sync_fault_injection": lambda: random.randint(0, 1),
     "get_property_one_in": 1000000,
-    "paranoid_file_checks": lambda: random.choice([0, 1, 1, 1]),
+    "paranoid_file_checks": lambda: random.choices((0, 1), weights=(1, 3))[0],
     "max_write_buffer_size_to_maintain": lambda: random.choice(
-        [0, 1024 * 1024, 2 * 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024]
+        (0, 1024 * 1024, 2 * 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024)
     ),
     "user_timestamp_size": 0,
-    "secondary_cache_fault_one_in": lambda: random.choice([0, 0, 32]),
-    "prepopulate_block_cache": lambda: random.choice([0, 1]),
-    "memtable_prefix_bloom_size_ratio": lambda: random.choice([0.001, 0.01, 0.1, 0.5]),
+    "secondary_cache_fault_one_in": lambda: random.choices((0, 32), weights=(2, 1))[0],
+    "prepopulate_block_cache": lambda: random.choice((0, 1)),
+    "memtable_prefix_bloom_size_ratio": lambda: random.choice((0.001, 0.01, 0.1, 0.5)),
     "memtable_whole_key_filtering": lambda: random.randint(0, 1),
-    "detect_filter_construct_corruption": lambda: random.choice([0, 1]),
-    "adaptive_readahead": lambda: random.choice([0, 1]),
-    "async_io": lambda: random.choice([0, 1]),
-    "wal_compression": lambda: random.choice(["none", "zstd"]),
+    "detect_filter_construct_corruption": lambda: random.choice((0, 1)),
+    "adaptive_readahead": lambda: random.choice((0, 1)),
+    "async_io": lambda: random.choice((0, 1)),
+    "wal_compression": lambda: random.choice(("none", "zstd")),
     "verify_sst_unique_id_in_manifest": 1,  # always do unique_id verification
     "secondary_cache_uri": lambda: random.choice(
-        [
+        (
             "",
             "compressed_secondary_cache://capacity=8388608",
             "compressed_secondary_cache://capacity=8388608;enable_custom_split_merge=true",
-        ]
+        )
     ),
     "allow_data_in_errors": True,
-    "readahead_size": lambda: random.choice([0, 16384, 524288]),
-    "initial_auto_readahead_size": lambda: random.choice([0, 16384, 524288]),
-    "max_auto_readahead_size": lambda: random.choice([0, 16384, 524288]),
-    "num_file_reads_for_auto_readahead": lambda: random.choice([0, 1, 2]),
-    "min_write_buffer_number_to_merge": lambda: random.choice([1, 2]),
-    "preserve_internal_time_seconds": lambda: random.choice([0, 60, 3600, 36000]),
+    "readahead_size": lambda: random.choice((0, 16384, 524288)),
+    "initial_auto_readahead_size": lambda: random.choice((0, 16384, 524288)),
+    "max_auto_readahead_size": lambda: random.choice((0, 16384, 524288)),
+    "num_file_reads_for_auto_readahead": lambda: random.choice((0, 1, 2)),
+    "min_write_buffer_number_to_merge": lambda: random.choice((1, 2)),
+    "preserve_internal_time_seconds": lambda: random.choice((0, 60, 3600, 36000)),
     # cannot change seed between runs because the seed decides which keys are nonoverwrittenable
     "seed": int(time.time() * 1000000) & 0xffffffff,
     "verify_before_write": lambda: random.randrange(20) == 0,
     "allow_concurrent_memtable_write": lambda: random.randint(0, 1),
     # only done when thread#0 does TestAcquireSnapshot. 
-    "compare_full_db_state_snapshot": lambda: random.choice([0, 0, 0, 1]),
+    "compare_full_db_state_snapshot": lambda: random.choices((0, 1), weights=(3, 1))[0],
     "num_iterations": lambda: random.randint(0, 100),
     "sync_wal_one_in": 100000,
     "customopspercent": 0,
     # "filter_uri": lambda: random.choice(["speedb.PairedBloomFilter", ""]),
-    "memtablerep": lambda: random.choice(["skip_list", "hash_spdb"]),
-    "pinning_policy": lambda: random.choice(["default", "scoped"]),
-    "use_dynamic_delay": lambda: random.choice([0, 1, 1, 1]),
+    "memtablerep": lambda: random.choice(("skip_list", "hash_spdb")),
+    "pinning_policy": lambda: random.choice(("default", "scoped")),
+    "use_dynamic_delay": lambda: random.choices((0, 1), weights=(1, 3))[0],
     "allow_wbm_stalls": lambda: random.randint(0, 1),
     "start_delay_percent": lambda: random.randint(0, 99),
     "use_clean_delete_during_flush": lambda: random.randint(0, 1),
@@ -254,6 +266,14 @@ def is_release_mode():
     return os.environ.get(_DEBUG_LEVEL_ENV_VAR) == "0"
 
 
+# Runs cleanup_cmd and returns its exit code. It goes through the shell, since
+# the command comes from the DB_CLEANUP_CMD make variable and may use globs or
+# variables.
+def run_cleanup_cmd():
+    print("Running DB cleanup command - %s\n" % cleanup_cmd)
+    return subprocess.run(cleanup_cmd, shell=True).returncode
+
+
 def get_dbname(test_name):
     test_dir_name = "rocksdb_crashtest_" + test_name
     test_tmpdir = os.environ.get(_TEST_DIR_ENV_VAR)
@@ -262,10 +282,9 @@ def get_dbname(test_name):
     else:
         dbname = test_tmpdir + "/" + test_dir_name
         shutil.rmtree(dbname, True)
-        if cleanup_cmd is not None:
-            print("Running DB cleanup command - %s\n" % cleanup_cmd)
+        if cleanup_cmd:
             # Ignore failure
-            os.system(cleanup_cmd)
+            run_cleanup_cmd()
         os.mkdir(dbname)
     return dbname
 
@@ -312,15 +331,36 @@ def setup_multiops_txn_key_spaces_file():
     return multiops_txn_key_spaces_file
 
 
-def is_direct_io_supported(dbname):
-    with tempfile.NamedTemporaryFile(dir=dbname) as f:
+def probe_direct_io(dirname):
+    with tempfile.NamedTemporaryFile(dir=dirname) as f:
         try:
-            os.open(f.name, os.O_DIRECT)
+            os.close(os.open(f.name, os.O_DIRECT))
         except BaseException:
             return False
         return True
 
 
+# All the DBs of a run are created under TEST_TMPDIR when it is set, so probe
+# it once up front and share the result with every directory below it.
+_direct_io_test_tmpdir = os.environ.get(_TEST_DIR_ENV_VAR)
+if _direct_io_test_tmpdir and os.path.isdir(_direct_io_test_tmpdir):
+    _direct_io_test_tmpdir = os.path.realpath(_direct_io_test_tmpdir)
+    _test_tmpdir_direct_io_supported = probe_direct_io(_direct_io_test_tmpdir)
+else:
+    _direct_io_test_tmpdir = None
+
+
+# Direct IO support is a property of the filesystem, which does not change
+# during the run, so probe each directory only once.
+@functools.lru_cache(maxsize=None)
+def is_direct_io_supported(dbname):
+    if _direct_io_test_tmpdir is not None:
+        path = os.path.realpath(dbname)
+        if os.path.commonpath([path, _direct_io_test_tmpdir]) == _direct_io_test_tmpdir:
+            return _test_tmpdir_direct_io_supported
+    return probe_direct_io(dbname)
+
+
 def generate_key_dist_and_len(params):
     # check if user supplied key dist or len
     if params["max_key_len"] == 0 and params["key_len_percent_dist"] != "0":
@@ -331,7 +371,7 @@ def generate_key_dist_and_len(params):
         params["max_key_len"] = random.randint(1, 10)
     
     dist = random_distribution(params["max_key_len"] - 1)
-    params["key_len_percent_dist"] = ",".join(str(i) for i in dist)
+    params["key_len_percent_dist"] = ",".join(map(str, dist))
 
 
 # Randomly select unique points (cut_points) on the distribution range
@@ -339,18 +379,18 @@ def generate_key_dist_and_len(params):
 # Inspired by the following post, with changes to disallow 0:
 # https://math.stackexchange.com/questions/1276206/method-of-generating-random-numbers-that-sum-to-100-is-this-truly-random/1276225#1276225
 def random_distribution(cuts_count):
-    cut_points = set()
-    while len(cut_points) < cuts_count:
-        cut_points.add(random.randint(1, 100 - 1))
+    cut_points = sorted(random.sample(range(1, 100), cuts_count))
     dist = []
-    for x in sorted(cut_points):
-        dist.append(x - sum(dist))
-    dist.append(100 - sum(dist))
+    prev = 0
+    for x in cut_points:
+        dist.append(x - prev)
+        prev = x
+    dist.append(100 - prev)
     return dist
 
 
 blackbox_default_params = {
-    "disable_wal": lambda: random.choice([0, 0, 0, 1]),
+    "disable_wal": lambda: random.choices((0, 1), weights=(3, 1))[0],
     # total time for this script to test db_stress
     "duration": 4000,
     # time for one db_stress instance to run
@@ -386,7 +426,7 @@ simple_default_params = {
     "test_batches_snapshots": 0,
     "write_buffer_size": 32 * 1024 * 1024,
     "level_compaction_dynamic_level_bytes": False,
-    "paranoid_file_checks": lambda: random.choice([0, 1, 1, 1]),
+    "paranoid_file_checks": lambda: random.choices((0, 1), weights=(1, 3))[0],
     "verify_iterator_with_expected_state_one_in": 5,  # this locks a range of keys
 }
 
@@ -441,22 +481,22 @@ blob_params = {
     "allow_setting_blob_options_dynamically": 1,
     # Enable blob files and GC with a 75% chance initially; note that they might still be
     # enabled/disabled during the test via SetOptions
-    "enable_blob_files": lambda: random.choice([0] + [1] * 3),
-    "min_blob_size": lambda: random.choice([0, 8, 16]),
-    "blob_file_size": lambda: random.choice([1048576, 16777216, 268435456, 1073741824]),
-    "blob_compression_type": lambda: random.choice(["none", "snappy", "lz4", "zstd"]),
-    "enable_blob_garbage_collection": lambda: random.choice([0] + [1] * 3),
+    "enable_blob_files": lambda: random.choices((0, 1), weights=(1, 3))[0],
+    "min_blob_size": lambda: random.choice((0, 8, 16)),
+    "blob_file_size": lambda: random.choice((1048576, 16777216, 268435456, 1073741824)),
+    "blob_compression_type": lambda: random.choice(("none", "snappy", "lz4", "zstd")),
+    "enable_blob_garbage_collection": lambda: random.choices((0, 1), weights=(1, 3))[0],
     "blob_garbage_collection_age_cutoff": lambda: random.choice(
-        [0.0, 0.25, 0.5, 0.75, 1.0]
-    ),
-    "blob_garbage_collection_force_threshold": lambda: random.choice([0.5, 0.75, 1.0]),
-    "blob_compaction_readahead_size": lambda: random.choice([0, 1048576, 4194304]),
-    "blob_file_starting_level": lambda: random.choice(
-        [0] * 4 + [1] * 3 + [2] * 2 + [3]
+        (0.0, 0.25, 0.5, 0.75, 1.0)
     ),
+    "blob_garbage_collection_force_threshold": lambda: random.choice((0.5, 0.75, 1.0)),
+    "blob_compaction_readahead_size": lambda: random.choice((0, 1048576, 4194304)),
+    "blob_file_starting_level": lambda: random.choices(
+        (0, 1, 2, 3), weights=(4, 3, 2, 1)
+    )[0],
     "use_blob_cache": lambda: random.randint(0, 1),
     "use_shared_block_and_blob_cache": lambda: random.randint(0, 1),
-    "blob_cache_size": lambda: random.choice([1048576, 2097152, 4194304, 8388608]),
+    "blob_cache_size": lambda: random.choice((1048576, 2097152, 4194304, 8388608)),
     "prepopulate_blob_cache": lambda: random.randint(0, 1),
 }
 
@@ -475,7 +515,7 @@ ts_params = {
 tiered_params = {
     "enable_tiered_storage": 1,
     # Set tiered compaction hot data time as: 1 minute, 1 hour, 10 hour
-    "preclude_last_level_data_seconds": lambda: random.choice([60, 3600, 36000]),
+    "preclude_last_level_data_seconds": lambda: random.choice((60, 3600, 36000)),
     # only test universal compaction for now, level has known issue of
     # endless compaction
     "compaction_style": 1,
@@ -489,13 +529,13 @@ multiops_txn_default_params = {
     "test_batches_snapshots": 0,
     "test_multi_ops_txns": 1,
     "use_txn": 1,
-    "two_write_queues": lambda: random.choice([0, 1]),
+    "two_write_queues": lambda: random.choice((0, 1)),
     # TODO: enable write-prepared
     "disable_wal": 0,
-    "use_only_the_last_commit_time_batch_for_recovery": lambda: random.choice([0, 1]),
+    "use_only_the_last_commit_time_batch_for_recovery": lambda: random.choice((0, 1)),
     "clear_column_family_one_in": 0,
     "column_families": 1,
-    "enable_pipelined_write": lambda: random.choice([0, 1]),
+    "enable_pipelined_write": lambda: random.choice((0, 1)),
     # This test already acquires snapshots in reads
     "acquire_snapshot_one_in": 0,
     "backup_one_in": 0,
@@ -568,11 +608,11 @@ narrow_params = {
     "acquire_snapshot_one_in": int(narrow_ops_per_thread / 4),
     "sync_wal_one_in": int(narrow_ops_per_thread / 2),
     "verify_db_one_in": int(narrow_ops_per_thread),
-    "use_multiget": lambda: random.choice([0, 0, 0, 1]),
-    "enable_compaction_filter": lambda: random.choice([0, 0, 0, 1]), 
-    "use_multiget": lambda: random.choice([0, 0, 0, 1]), 
-    "compare_full_db_state_snapshot": lambda: random.choice([0, 0, 0, 1]), 
-    "use_merge": lambda: random.choice([0, 0, 0, 1]), 
+    "use_multiget": lambda: random.choices((0, 1), weights=(3, 1))[0],
+    "enable_compaction_filter": lambda: random.choices((0, 1), weights=(3, 1))[0], 
+    "use_multiget": lambda: random.choices((0, 1), weights=(3, 1))[0], 
+    "compare_full_db_state_snapshot": lambda: random.choices((0, 1), weights=(3, 1))[0], 
+    "use_merge": lambda: random.choices((0, 1), weights=(3, 1))[0], 
     "nooverwritepercent": random.choice([0, 5, 20, 30, 40, 50, 95]), 
     "seed": int(time.time() * 1000000) & 0xffffffff,
 
@@ -586,237 +626,452 @@ narrow_params = {
 }
 
 
+# Every param this script knows about, used to declare the command line flags.
+_ALL_PARAMS = {
+    **default_params,
+    **blackbox_default_params,
+    **whitebox_default_params,
+    **simple_default_params,
+    **blackbox_simple_default_params,
+    **whitebox_simple_default_params,
+    **blob_params,
+    **ts_params,
+    **supplied_ops,
+    **narrow_params,
+    **multiops_txn_default_params,
+    **multiops_wc_txn_params,
+    **multiops_wp_txn_params,
+    **best_efforts_recovery_params,
+    **cf_consistency_params,
+    **tiered_params,
+    **txn_params,
+}
+
+
 def store_ops_supplied(params):
     for k in supplied_ops:
         supplied_ops[k] = params.get(k, -1)
 
 
+# Ops that get their random percentage from a narrower range as long as enough
+# of the budget is left, as {op: (minimal budget, draw(budget))}. Other ops
+# draw uniformly from whatever budget is left.
+_OP_PERCENT_DRAWS = {
+    "writepercent": (61, lambda budget: random.randint(20, 60)),
+    "delpercent": (36, lambda budget: random.randint(0, budget - 35)),
+    "prefixpercent": (10, lambda budget: random.randint(0, 10)),
+    "delrangepercent": (5, lambda budget: random.randint(0, 5)),
+}
+
+
 # make sure sum of ops == 100.
 # value of -1 means that the op should be initialized. 
 def randomize_operation_type_percentages(src_params):
-    num_to_initialize = sum(1 for v in supplied_ops.values() if v == -1)
-    
-    params = {k: (v if v != -1 else 0) for k, v in supplied_ops.items()}
-
-    ops_percent_sum = sum(params.get(k, 0) for k in supplied_ops)
-    current_max = 100 - ops_percent_sum
-    if ops_percent_sum > 100 or (num_to_initialize == 0 and ops_percent_sum != 100):
+    params = {}
+    to_initialize = []
+    ops_percent_sum = 0
+    for k, v in supplied_ops.items():
+        if v == -1:
+            to_initialize.append(k)
+            v = 0
+        params[k] = v
+        ops_percent_sum += v
+
+    if ops_percent_sum > 100 or (not to_initialize and ops_percent_sum != 100):
         raise ValueError("Error - Sum of ops percents should be 100")
-    
-    if num_to_initialize != 0:        
-        for k , v in supplied_ops.items():
-            if v != -1:
-                continue
-            
-            if num_to_initialize == 1:
-                params[k] = current_max
-                break
-
-            if k == "writepercent" and current_max > 60:
-                params["writepercent"] = random.randint(20, 60)
-            elif k == "delpercent" and current_max > 35:
-                params["delpercent"] = random.randint(0, current_max - 35)
-            elif k == "prefixpercent" and current_max >= 10:
-                params["prefixpercent"] = random.randint(0, 10)
-            elif k == "delrangepercent" and current_max >= 5:
-                params["delrangepercent"] = random.randint(0, 5)
+
+    if to_initialize:
+        current_max = 100 - ops_percent_sum
+        # The last op takes whatever is left so that the sum is 100.
+        last = to_initialize.pop()
+        for k in to_initialize:
+            draw = _OP_PERCENT_DRAWS.get(k)
+            if draw is not None and current_max >= draw[0]:
+                params[k] = draw[1](current_max)
             else:
                 params[k] = random.randint(0, current_max)
-            
-            current_max = current_max - params[k]
-            num_to_initialize -= 1
+            current_max -= params[k]
+        params[last] = current_max
 
     src_params.update(params)
 
 
-def finalize_and_sanitize(src_params, counter):
-    dest_params = {k: v() if callable(v) else v for (k, v) in src_params.items()}
+def _direct_io_overrides(params):
     if is_release_mode():
-        dest_params["read_fault_one_in"] = 0
-    if dest_params.get("compression_max_dict_bytes") == 0:
-        dest_params["compression_zstd_max_train_bytes"] = 0
-        dest_params["compression_max_dict_buffer_bytes"] = 0
-    if dest_params.get("compression_type") != "zstd":
-        dest_params["compression_zstd_max_train_bytes"] = 0
-    if dest_params["mmap_read"] == 1:
-        dest_params["use_direct_io_for_flush_and_compaction"] = 0
-        dest_params["use_direct_reads"] = 0
-        if dest_params["file_checksum_impl"] != "none":
-            # TODO(T109283569): there is a bug in `GenerateOneFileChecksum()`,
-            # used by `IngestExternalFile()`, causing it to fail with mmap
-            # reads. Remove this once it is fixed.
-            dest_params["ingest_external_file_one_in"] = 0
-    if (
-        dest_params["use_direct_io_for_flush_and_compaction"] == 1
-        or dest_params["use_direct_reads"] == 1
-    ) and not is_direct_io_supported(dest_params["db"]):
-        if is_release_mode():
-            print(
-                "{} does not support direct IO. Disabling use_direct_reads and "
-                "use_direct_io_for_flush_and_compaction.\n".format(dest_params["db"])
-            )
-            dest_params["use_direct_reads"] = 0
-            dest_params["use_direct_io_for_flush_and_compaction"] = 0
-        else:
-            dest_params["mock_direct_io"] = True
-
-    if dest_params.get("test_batches_snapshots") == 1:
-        dest_params["enable_compaction_filter"] = 0
-        if dest_params["prefix_size"] < 0:
-            dest_params["prefix_size"] = 1
-
+        print(
+            "{} does not support direct IO. Disabling use_direct_reads and "
+            "use_direct_io_for_flush_and_compaction.\n".format(params["db"])
+        )
+        return {"use_direct_reads": 0, "use_direct_io_for_flush_and_compaction": 0}
+    return {"mock_direct_io": True}
+
+
+# A conflict resolution rule applied by finalize_and_sanitize() once the params
+# are evaluated: when `predicate(params)` is true the params are updated with
+# `overrides`, which is either a dict or a function that computes one from the
+# current params. `reads` are the params the predicate tests or the overrides
+# are computed from, and `writes` the params the rule may set; the latter
+# default to the keys of `overrides`. finalize_static() uses them to find the
+# rules that may fire in a crash test.
+SanitizeRule = collections.namedtuple(
+    "SanitizeRule", ["reads", "writes", "predicate", "overrides"]
+)
+
+
+def _rule(reads, predicate, overrides, writes=None):
+    if writes is None:
+        writes = overrides.keys()
+    return SanitizeRule(frozenset(reads), frozenset(writes), predicate, overrides)
+
+
+# The rules are applied in table order, so each rule sees the writes of the
+# rules above it and none of those below it.
+_SANITIZE_RULES = [
+    _rule(set(), lambda p: is_release_mode(), {"read_fault_one_in": 0}),
+    _rule(
+        {"compression_max_dict_bytes"},
+        lambda p: p.get("compression_max_dict_bytes") == 0,
+        {
+            "compression_zstd_max_train_bytes": 0,
+            "compression_max_dict_buffer_bytes": 0,
+        },
+    ),
+    _rule(
+        {"compression_type"},
+        lambda p: p.get("compression_type") != "zstd",
+        {"compression_zstd_max_train_bytes": 0},
+    ),
+    _rule(
+        {"mmap_read"},
+        lambda p: p["mmap_read"] == 1,
+        {"use_direct_io_for_flush_and_compaction": 0, "use_direct_reads": 0},
+    ),
+    # TODO(T109283569): there is a bug in `GenerateOneFileChecksum()`, used by
+    # `IngestExternalFile()`, causing it to fail with mmap reads. Remove this
+    # once it is fixed.
+    _rule(
+        {"mmap_read", "file_checksum_impl"},
+        lambda p: p["mmap_read"] == 1 and p["file_checksum_impl"] != "none",
+        {"ingest_external_file_one_in": 0},
+    ),
+    _rule(
+        {"use_direct_io_for_flush_and_compaction", "use_direct_reads", "db"},
+        lambda p: (
+            p["use_direct_io_for_flush_and_compaction"] == 1
+            or p["use_direct_reads"] == 1
+        ) and not is_direct_io_supported(p["db"]),
+        _direct_io_overrides,
+        writes={
+            "use_direct_reads",
+            "use_direct_io_for_flush_and_compaction",
+            "mock_direct_io",
+        },
+    ),
+    _rule(
+        {"test_batches_snapshots"},
+        lambda p: p.get("test_batches_snapshots") == 1,
+        {"enable_compaction_filter": 0},
+    ),
+    _rule(
+        {"test_batches_snapshots", "prefix_size"},
+        lambda p: p.get("test_batches_snapshots") == 1 and p["prefix_size"] < 0,
+        {"prefix_size": 1},
+    ),
     # Multi-key operations are not currently compatible with transactions or
     # timestamp.
-    if (dest_params.get("test_batches_snapshots") == 1 or
-        dest_params.get("use_txn") == 1 or
-        dest_params.get("user_timestamp_size") > 0):
-        dest_params["ingest_external_file_one_in"] = 0
-    if (dest_params.get("test_batches_snapshots") == 1 or
-        dest_params.get("use_txn") == 1):
-        dest_params["delpercent"] += dest_params["delrangepercent"]
-        dest_params["delrangepercent"] = 0
-    if (
-        dest_params.get("disable_wal") == 1
-        or dest_params.get("sync_fault_injection") == 1
-        or dest_params.get("manual_wal_flush_one_in", 0) > 0
-    ):
-        # File ingestion does not guarantee prefix-recoverability when unsynced
-        # data can be lost. Ingesting a file syncs data immediately that is
-        # newer than unsynced memtable data that can be lost on restart.
-        #
-        # Even if the above issue is fixed or worked around, our
-        # trace-and-replay does not trace file ingestion, so in its current form
-        # it would not recover the expected state to the correct point in time.
-        dest_params["ingest_external_file_one_in"] = 0
-        # The `DbStressCompactionFilter` can apply memtable updates to SST
-        # files, which would be problematic when unsynced data can be lost in
-        # crash recoveries.
-        dest_params["enable_compaction_filter"] = 0
-    # Only under WritePrepared txns, unordered_write would provide the same guarnatees as vanilla rocksdb
-    if dest_params.get("unordered_write", 0) == 1:
-        dest_params["txn_write_policy"] = 1
-        dest_params["allow_concurrent_memtable_write"] = 1
-    if dest_params.get("allow_concurrent_memtable_write", 0) == 1:
-        if (dest_params.get("memtablerep") != "skip_list" and 
-            dest_params.get("memtablerep") != "hash_spdb"):
-                dest_params["memtablerep"] = random.choice(
-                    ["skip_list", "hash_spdb"]
-                )
-    if dest_params.get("disable_wal", 0) == 1:
-        dest_params["atomic_flush"] = 1
-        dest_params["sync"] = 0
-        dest_params["write_fault_one_in"] = 0
-    if dest_params.get("open_files", 1) != -1:
-        # Compaction TTL and periodic compactions are only compatible
-        # with open_files = -1
-        dest_params["compaction_ttl"] = 0
-        dest_params["periodic_compaction_seconds"] = 0
-    if dest_params.get("compaction_style", 0) == 2:
-        # Disable compaction TTL in FIFO compaction, because right
-        # now assertion failures are triggered.
-        dest_params["compaction_ttl"] = 0
-        dest_params["periodic_compaction_seconds"] = 0
-    if dest_params["partition_filters"] == 1:
-        if dest_params["index_type"] != 2:
-            dest_params["partition_filters"] = 0
-    if dest_params.get("atomic_flush", 0) == 1:
-        # disable pipelined write when atomic flush is used.
-        dest_params["enable_pipelined_write"] = 0
-    if dest_params.get("sst_file_manager_bytes_per_sec", 0) == 0:
-        dest_params["sst_file_manager_bytes_per_truncate"] = 0
-    if dest_params.get("read_only", 0) == 1:
-        if counter == 0:
-            dest_params["read_only"] = 0
-        else:
-            dest_params["readpercent"] += dest_params["writepercent"]
-            dest_params["writepercent"] = 0
-            dest_params["iterpercent"] += dest_params["delpercent"]
-            dest_params["delpercent"] = 0
-            dest_params["iterpercent"] += dest_params["delrangepercent"]
-            dest_params["delrangepercent"] = 0 
-    if dest_params.get("enable_compaction_filter", 0) == 1:
-        # Compaction filter is incompatible with snapshots. Need to avoid taking
-        # snapshots, as well as avoid operations that use snapshots for
-        # verification.
-        dest_params["acquire_snapshot_one_in"] = 0
-        dest_params["compact_range_one_in"] = 0
-        # Give the iterator ops away to reads.
-        dest_params["readpercent"] += dest_params.get("iterpercent", 0)
-        dest_params["iterpercent"] = 0
-    if dest_params.get("prefix_size") == -1:
-        dest_params["readpercent"] += dest_params.get("prefixpercent", 20)
-        dest_params["prefixpercent"] = 0
-    if (
-        dest_params.get("prefix_size") == -1
-        and dest_params.get("memtable_whole_key_filtering") == 0
-    ):
-        dest_params["memtable_prefix_bloom_size_ratio"] = 0
-    if dest_params.get("two_write_queues") == 1:
-        dest_params["enable_pipelined_write"] = 0
-    if dest_params.get("best_efforts_recovery") == 1:
-        dest_params["disable_wal"] = 1
-        dest_params["atomic_flush"] = 0
-        dest_params["enable_compaction_filter"] = 0
-        dest_params["sync"] = 0
-        dest_params["write_fault_one_in"] = 0
+    _rule(
+        {"test_batches_snapshots", "use_txn", "user_timestamp_size"},
+        lambda p: p.get("test_batches_snapshots") == 1
+        or p.get("use_txn") == 1
+        or p.get("user_timestamp_size") > 0,
+        {"ingest_external_file_one_in": 0},
+    ),
+    _rule(
+        {"test_batches_snapshots", "use_txn", "delpercent", "delrangepercent"},
+        lambda p: p.get("test_batches_snapshots") == 1 or p.get("use_txn") == 1,
+        lambda p: {
+            "delpercent": p["delpercent"] + p["delrangepercent"],
+            "delrangepercent": 0,
+        },
+        writes={"delpercent", "delrangepercent"},
+    ),
+    # File ingestion does not guarantee prefix-recoverability when unsynced
+    # data can be lost. Ingesting a file syncs data immediately that is newer
+    # than unsynced memtable data that can be lost on restart.
+    #
+    # Even if the above issue is fixed or worked around, our trace-and-replay
+    # does not trace file ingestion, so in its current form it would not
+    # recover the expected state to the correct point in time.
+    #
+    # The `DbStressCompactionFilter` can apply memtable updates to SST files,
+    # which would be problematic when unsynced data can be lost in crash
+    # recoveries.
+    _rule(
+        {"disable_wal", "sync_fault_injection", "manual_wal_flush_one_in"},
+        lambda p: p.get("disable_wal") == 1
+        or p.get("sync_fault_injection") == 1
+        or p.get("manual_wal_flush_one_in", 0) > 0,
+        {"ingest_external_file_one_in": 0, "enable_compaction_filter": 0},
+    ),
+    # Only under WritePrepared txns, unordered_write would provide the same
+    # guarnatees as vanilla rocksdb
+    _rule(
+        {"unordered_write"},
+        lambda p: p.get("unordered_write", 0) == 1,
+        {"txn_write_policy": 1, "allow_concurrent_memtable_write": 1},
+    ),
+    _rule(
+        {"allow_concurrent_memtable_write", "memtablerep"},
+        lambda p: p.get("allow_concurrent_memtable_write", 0) == 1
+        and p.get("memtablerep") not in ("skip_list", "hash_spdb"),
+        lambda p: {"memtablerep": random.choice(("skip_list", "hash_spdb"))},
+        writes={"memtablerep"},
+    ),
+    _rule(
+        {"disable_wal"},
+        lambda p: p.get("disable_wal", 0) == 1,
+        {"atomic_flush": 1, "sync": 0, "write_fault_one_in": 0},
+    ),
+    # Compaction TTL and periodic compactions are only compatible with
+    # open_files = -1
+    _rule(
+        {"open_files"},
+        lambda p: p.get("open_files", 1) != -1,
+        {"compaction_ttl": 0, "periodic_compaction_seconds": 0},
+    ),
+    # Disable compaction TTL in FIFO compaction, because right now assertion
+    # failures are triggered.
+    _rule(
+        {"compaction_style"},
+        lambda p: p.get("compaction_style", 0) == 2,
+        {"compaction_ttl": 0, "periodic_compaction_seconds": 0},
+    ),
+    _rule(
+        {"partition_filters", "index_type"},
+        lambda p: p["partition_filters"] == 1 and p["index_type"] != 2,
+        {"partition_filters": 0},
+    ),
+    # disable pipelined write when atomic flush is used.
+    _rule(
+        {"atomic_flush"},
+        lambda p: p.get("atomic_flush", 0) == 1,
+        {"enable_pipelined_write": 0},
+    ),
+    _rule(
+        {"sst_file_manager_bytes_per_sec"},
+        lambda p: p.get("sst_file_manager_bytes_per_sec", 0) == 0,
+        {"sst_file_manager_bytes_per_truncate": 0},
+    ),
+    _rule(
+        {
+            "read_only",
+            "readpercent",
+            "writepercent",
+            "iterpercent",
+            "delpercent",
+            "delrangepercent",
+        },
+        lambda p: p.get("read_only", 0) == 1,
+        lambda p: {
+            "readpercent": p["readpercent"] + p["writepercent"],
+            "writepercent": 0,
+            "iterpercent": p["iterpercent"] + p["delpercent"] + p["delrangepercent"],
+            "delpercent": 0,
+            "delrangepercent": 0,
+        },
+        writes={
+            "readpercent",
+            "writepercent",
+            "iterpercent",
+            "delpercent",
+            "delrangepercent",
+        },
+    ),
+    # Compaction filter is incompatible with snapshots. Need to avoid taking
+    # snapshots, as well as avoid operations that use snapshots for
+    # verification. Give the iterator ops away to reads.
+    _rule(
+        {"enable_compaction_filter", "readpercent", "iterpercent"},
+        lambda p: p.get("enable_compaction_filter", 0) == 1,
+        lambda p: {
+            "acquire_snapshot_one_in": 0,
+            "compact_range_one_in": 0,
+            "readpercent": p["readpercent"] + p.get("iterpercent", 0),
+            "iterpercent": 0,
+        },
+        writes={
+            "acquire_snapshot_one_in",
+            "compact_range_one_in",
+            "readpercent",
+            "iterpercent",
+        },
+    ),
+    _rule(
+        {"prefix_size", "readpercent", "prefixpercent"},
+        lambda p: p.get("prefix_size") == -1,
+        lambda p: {
+            "readpercent": p["readpercent"] + p.get("prefixpercent", 20),
+            "prefixpercent": 0,
+        },
+        writes={"readpercent", "prefixpercent"},
+    ),
+    _rule(
+        {"prefix_size", "memtable_whole_key_filtering"},
+        lambda p: p.get("prefix_size") == -1
+        and p.get("memtable_whole_key_filtering") == 0,
+        {"memtable_prefix_bloom_size_ratio": 0},
+    ),
+    _rule(
+        {"two_write_queues"},
+        lambda p: p.get("two_write_queues") == 1,
+        {"enable_pipelined_write": 0},
+    ),
+    _rule(
+        {"best_efforts_recovery"},
+        lambda p: p.get("best_efforts_recovery") == 1,
+        {
+            "disable_wal": 1,
+            "atomic_flush": 0,
+            "enable_compaction_filter": 0,
+            "sync": 0,
+            "write_fault_one_in": 0,
+        },
+    ),
     # Remove the following once write-prepared/write-unprepared with/without
     # unordered write supports timestamped snapshots
-    if dest_params.get("create_timestamped_snapshot_one_in", 0) > 0:
-        dest_params["txn_write_policy"] = 0
-        dest_params["unordered_write"] = 0
+    _rule(
+        {"create_timestamped_snapshot_one_in"},
+        lambda p: p.get("create_timestamped_snapshot_one_in", 0) > 0,
+        {"txn_write_policy": 0, "unordered_write": 0},
+    ),
     # For TransactionDB, correctness testing with unsync data loss is currently
     # compatible with only write committed policy
-    if (dest_params.get("use_txn") == 1 and dest_params.get("txn_write_policy") != 0):
-        dest_params["sync_fault_injection"] = 0
-        dest_params["manual_wal_flush_one_in"] = 0
-    # PutEntity is currently not supported by SstFileWriter or in conjunction with Merge
-    if dest_params.get("use_put_entity_one_in", 0) != 0:
-        dest_params["ingest_external_file_one_in"] = 0
-        dest_params["use_merge"] = 0
-        dest_params["use_full_merge_v1"] = 0
-
-    # make sure bloom_bits is not 0 when filter_uri is used since it fails in CreateFilterPolicy.
-    if dest_params.get("filter_uri") != "":
-        dest_params["bloom_bits"] = random.choice([random.randint(1,19),
-                                         random.lognormvariate(2.3, 1.3)])
+    _rule(
+        {"use_txn", "txn_write_policy"},
+        lambda p: p.get("use_txn") == 1 and p.get("txn_write_policy") != 0,
+        {"sync_fault_injection": 0, "manual_wal_flush_one_in": 0},
+    ),
+    # PutEntity is currently not supported by SstFileWriter or in conjunction
+    # with Merge
+    _rule(
+        {"use_put_entity_one_in"},
+        lambda p: p.get("use_put_entity_one_in", 0) != 0,
+        {"ingest_external_file_one_in": 0, "use_merge": 0, "use_full_merge_v1": 0},
+    ),
+    # make sure bloom_bits is not 0 when filter_uri is used since it fails in
+    # CreateFilterPolicy.
+    _rule(
+        {"filter_uri"},
+        lambda p: p.get("filter_uri") != "",
+        lambda p: {
+            "bloom_bits": random.choice(
+                [random.randint(1, 19), random.lognormvariate(2.3, 1.3)]
+            )
+        },
+        writes={"bloom_bits"},
+    ),
+]
+
+
+# Params that may differ between the runs of one crash test whatever params it
+# was started with: the op percentages are drawn again for every run and the
+# first run never opens the DB read-only.
+_PER_RUN_PARAMS = frozenset(supplied_ops) | {"read_only"}
+
+# Params that whitebox_crash_main() overrides differently from run to run.
+# finalize_static() only checks once the rules that read none of them, so the
+# loop refuses to run with an override that is missing here.
+_WHITEBOX_RUN_PARAMS = frozenset({
+    "ops_per_thread",
+    "kill_random_test",
+    "kill_exclude_prefixes",
+    "compaction_style",
+    "num_levels",
+    "destroy_db_initially",
+})
+
+
+# Returns the sanitize rules that may fire for some run of a crash test started
+# with `params`, in the order finalize_and_sanitize() applies them. A rule whose
+# predicate only reads params that are the same for every run, i.e. that are
+# neither evaluated per run, in `per_run_keys` or written by a rule that may
+# fire, gets the same answer every time, so it is checked once here and
+# dropped when it never fires.
+def finalize_static(params, per_run_keys=()):
+    dynamic = set(_PER_RUN_PARAMS)
+    dynamic.update(per_run_keys)
+    dynamic.update(k for k, v in params.items() if callable(v))
+    static_params = {k: v for k, v in params.items() if k not in dynamic}
+    rules = []
+    for rule in _SANITIZE_RULES:
+        if rule.reads.isdisjoint(dynamic) and not rule.predicate(static_params):
+            continue
+        rules.append(rule)
+        dynamic.update(rule.writes)
+    return rules
+
+
+def finalize_and_sanitize(src_params, counter, rules=None):
+    # Bind the builtin locally so that evaluating ~150 params does not go
+    # through the globals and builtins lookups for every one of them.
+    is_callable = callable
+    dest_params = {k: v() if is_callable(v) else v for (k, v) in src_params.items()}
+    get = dest_params.get
+    # The first run always opens the DB for writes.
+    if counter == 0 and get("read_only", 0) == 1:
+        dest_params["read_only"] = 0
+    if rules is None:
+        rules = _SANITIZE_RULES
+    for _, _, predicate, overrides in rules:
+        if predicate(dest_params):
+            if is_callable(overrides):
+                overrides = overrides(dest_params)
+            # Most overrides disable something that is already off, so only
+            # the params that actually change are written.
+            # Compare the types too, so that e.g. a False param is still set
+            # to 0 and db_stress sees the flag as the override spells it.
+            for k, v in overrides.items():
+                cur = get(k)
+                if type(cur) is not type(v) or cur != v:
+                    dest_params[k] = v
 
     # db_bench will abort if using ScopedPinningPolicy and not setting cache_index_and_filter_blocks
-    if dest_params.get("pinning_policy") == "ScopedPinning":
+    if get("pinning_policy") == "ScopedPinning":
         dest_params["cache_index_and_filter_blocks"]
         
     return dest_params
 
 
 def gen_cmd_params(args):
-    params = {}
-
-    params.update(default_params)
+    # Layers are listed from lowest to highest priority, see "params overwrite
+    # priority" at the top of this file.
+    layers = [default_params]
     if args.test_type == "blackbox":
-        params.update(blackbox_default_params)
+        layers.append(blackbox_default_params)
     if args.test_type == "whitebox":
-        params.update(whitebox_default_params)
+        layers.append(whitebox_default_params)
     if args.simple:
-        params.update(simple_default_params)
+        layers.append(simple_default_params)
         if args.test_type == "blackbox":
-            params.update(blackbox_simple_default_params)
+            layers.append(blackbox_simple_default_params)
         if args.test_type == "whitebox":
-            params.update(whitebox_simple_default_params)
+            layers.append(whitebox_simple_default_params)
     if args.cf_consistency:
-        params.update(cf_consistency_params)
+        layers.append(cf_consistency_params)
     if args.txn:
-        params.update(txn_params)
+        layers.append(txn_params)
     if args.test_best_efforts_recovery:
-        params.update(best_efforts_recovery_params)
+        layers.append(best_efforts_recovery_params)
     if args.enable_ts:
-        params.update(ts_params)
+        layers.append(ts_params)
     if args.test_multiops_txn:
-        params.update(multiops_txn_default_params)
+        layers.append(multiops_txn_default_params)
         if args.write_policy == "write_committed":
-            params.update(multiops_wc_txn_params)
+            layers.append(multiops_wc_txn_params)
         elif args.write_policy == "write_prepared":
-            params.update(multiops_wp_txn_params)
+            layers.append(multiops_wp_txn_params)
     if args.test_tiered_storage:
-        params.update(tiered_params)
+        layers.append(tiered_params)
 
     # Best-effort recovery, tiered storage are currently incompatible with BlobDB.
     # Test BE recovery if specified on the command line; otherwise, apply BlobDB
@@ -824,147 +1079,206 @@ def gen_cmd_params(args):
     if (
         not args.test_best_efforts_recovery
         and not args.test_tiered_storage
-        and random.choice([0] * 9 + [1]) == 1
+        and random.random() < 0.1
     ):
-        params.update(blob_params)
+        layers.append(blob_params)
+
+    # Merge the layers once, each key taking the value of the highest priority
+    # layer that has it. The result is a plain dict since every run of the
+    # test walks all of its params.
+    params = dict(
+        collections.ChainMap(
+            {k: v for k, v in vars(args).items() if v is not None},
+            *reversed(layers)
+        )
+    )
 
-    for k, v in vars(args).items():
-        if v is not None:
-            params[k] = v
-    
     if params["max_key_len"] == 0 or params["key_len_percent_dist"] == "0":
         generate_key_dist_and_len(params)
 
     return params
 
 
-def gen_cmd(params, unknown_params, counter):
-    finalzied_params = finalize_and_sanitize(params, counter)
+# Params that only drive this script and are not passed on to db_stress.
+_GEN_CMD_EXCLUDED = frozenset({
+    "test_type",
+    "simple",
+    "duration",
+    "interval",
+    "random_kill_odd",
+    "cf_consistency",
+    "txn",
+    "test_best_efforts_recovery",
+    "enable_ts",
+    "test_multiops_txn",
+    "write_policy",
+    "stress_cmd",
+    "test_tiered_storage",
+    "cleanup_cmd",
+    "disable_kill_points",
+})
+
+
+def gen_cmd(params, unknown_params, counter, rules=None):
+    finalzied_params = finalize_and_sanitize(params, counter, rules)
     cmd = (
         [stress_cmd]
         + [
-            "--{0}={1}".format(k, v)
-            for k, v in [(k, finalzied_params[k]) for k in sorted(finalzied_params)]
-            if k
-            not in {
-                "test_type",
-                "simple",
-                "duration",
-                "interval",
-                "random_kill_odd",
-                "cf_consistency",
-                "txn",
-                "test_best_efforts_recovery",
-                "enable_ts",
-                "test_multiops_txn",
-                "write_policy",
-                "stress_cmd",
-                "test_tiered_storage",
-                "cleanup_cmd",
-                "disable_kill_points",
-            }
-            and v is not None
+            "--%s=%s" % (k, v)
+            for k, v in sorted(finalzied_params.items())
+            if k not in _GEN_CMD_EXCLUDED and v is not None
         ]
         + unknown_params
     )
     return cmd
 
 
+# Non-empty stderr lines that are not warnings.
+_STDERR_ERROR_LINE_RE = re.compile(r"^(?!WARNING).+$", re.MULTILINE)
+
 DEADLY_SIGNALS = {
     signal.SIGABRT, signal.SIGBUS, signal.SIGFPE, signal.SIGILL, signal.SIGSEGV
 }
 
 
+# db_stress writes its stdout straight to ours as it runs, so only stderr, which
+# is checked for errors, is kept in memory.
 def execute_cmd(cmd, timeout):
-    child = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Make sure what we printed so far comes before the db_stress output.
+    sys.stdout.flush()
+    now = datetime.datetime.now
+    # Decode stderr as it is read; a stray invalid byte, e.g. from a corrupted
+    # key in an error message, must not abort the test.
+    child = subprocess.Popen(
+        cmd, stderr=subprocess.PIPE, encoding="utf-8", errors="replace"
+    )
     print("[%s] Running db_stress with pid=%d: %s\n\n" 
-    % (str(datetime.datetime.now()), child.pid, " ".join(cmd)))
+    % (str(now()), child.pid, " ".join(cmd)))
 
     try:
-        outs, errs = child.communicate(timeout=timeout)
+        _, errs = child.communicate(timeout=timeout)
         hit_timeout = False
         if child.returncode < 0 and (-child.returncode in DEADLY_SIGNALS):
             msg = ("[%s] ERROR: db_stress (pid=%d) failed before kill: "
                    "exitcode=%d, signal=%s\n") % (
-                    str(datetime.datetime.now()), child.pid, child.returncode,
+                    str(now()), child.pid, child.returncode,
                     signal.Signals(-child.returncode).name)
-            print(outs)
             print(errs, file=sys.stderr)
             print(msg)
             raise SystemExit(msg)
         print("[%s] WARNING: db_stress (pid=%d) ended before kill: exitcode=%d\n"
-              % (str(datetime.datetime.now()), child.pid, child.returncode))
+              % (str(now()), child.pid, child.returncode))
     except subprocess.TimeoutExpired:
         hit_timeout = True
         child.kill()
-        print("[%s] KILLED %d\n" % (str(datetime.datetime.now()), child.pid))
-        outs, errs = child.communicate()
+        print("[%s] KILLED %d\n" % (str(now()), child.pid))
+        _, errs = child.communicate()
+
+    return hit_timeout, child.returncode, errs
 
-    return hit_timeout, child.returncode, outs.decode("utf-8"), errs.decode("utf-8")
+
+# SST and blob files are never modified once written, so a copy of the db can
+# share them with the live db through hard links. Everything else, e.g. WAL
+# files, which may be recycled, or the MANIFEST, is copied.
+_IMMUTABLE_DB_FILE_SUFFIXES = (".sst", ".blob")
+
+
+def link_or_copy(src, dst):
+    if src.endswith(_IMMUTABLE_DB_FILE_SUFFIXES):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            # e.g. the destination is on another filesystem
+            pass
+    return shutil.copy2(src, dst)
+
+
+# The copy has to be taken while db_stress is not running, but removing an old
+# copy does not touch the live db, so it is left to a background thread and
+# overlaps with the next db_stress run.
+_old_copy_remover = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
 
 # old copy of the db is kept at same src dir as new db. 
 def copy_tree_and_remove_old(counter, dbname):
     dest = dbname + "_" + str(counter)
-    shutil.copytree(dbname, dest)
+    shutil.copytree(dbname, dest, copy_function=link_or_copy)
     shutil.copytree(expected_values_dir, dest + "/" + "expected_values_dir")
     old_db = dbname + "_" + str(counter - 2)
     if counter > 1:
-        shutil.rmtree(old_db, True)
+        # rmtree() ignores errors, so there is no result to check.
+        _old_copy_remover.submit(shutil.rmtree, old_db, True)
+
+
+def wait_for_old_copies_removal():
+    _old_copy_remover.shutdown(wait=True)
+
+
+# Cleans up after a test that passed: the copies of the db from the last two
+# runs, and the db itself if `with_db`, are removed by a single rm. Copies from
+# earlier runs are already gone or being removed in the background.
+def remove_db_and_last_copies(dbname, counter, with_db=True):
+    paths = [dbname] if with_db else []
+    paths += [
+        "{}_{}".format(dbname, ctr) for ctr in range(max(0, counter - 2), counter)
+    ]
+    if paths:
+        subprocess.run(["rm", "-rf", "--", *paths], check=False)
+    wait_for_old_copies_removal()
 
 
 def gen_narrow_cmd_params(args):
-    params = {}
-    params.update(narrow_params)
-    # add these to avoid a key error in finalize_and_sanitize
-    params["mmap_read"] = 0
-    params["use_direct_io_for_flush_and_compaction"] = 0
-    params["partition_filters"] = 0
-    params["use_direct_reads"] = 0
-    params["user_timestamp_size"] = 0
-    params["ribbon_starting_level"] = 0
-    params["secondary_cache_uri"] = ""
-
-    for k, v in vars(args).items():
-        if v is not None:
-            params[k] = v
-            
-    return params
+    return dict(
+        collections.ChainMap(
+            {k: v for k, v in vars(args).items() if v is not None},
+            # add these to avoid a key error in finalize_and_sanitize
+            {
+                "mmap_read": 0,
+                "use_direct_io_for_flush_and_compaction": 0,
+                "partition_filters": 0,
+                "use_direct_reads": 0,
+                "user_timestamp_size": 0,
+                "ribbon_starting_level": 0,
+                "secondary_cache_uri": "",
+            },
+            narrow_params,
+        )
+    )
 
 
 def narrow_crash_main(args, unknown_args):
     cmd_params = gen_narrow_cmd_params(args)
     dbname = get_dbname('narrow')
-    exit_time = time.time() + cmd_params['duration']
+    exit_time = time.monotonic() + cmd_params['duration']
     
     store_ops_supplied(cmd_params)
+    cmd_params["db"] = dbname
+    sanitize_rules = finalize_static(cmd_params)
 
     print("Running narrow-crash-test\n")
     
     counter = 0
     
-    while time.time() < exit_time:
+    while time.monotonic() < exit_time:
         randomize_operation_type_percentages(cmd_params)
-        cmd = gen_cmd(dict(cmd_params, **{'db': dbname}), unknown_args, counter)
+        cmd = gen_cmd(cmd_params, unknown_args, counter, sanitize_rules)
 
-        hit_timeout, retcode, outs, errs = execute_cmd(cmd, cmd_params['duration'])
+        hit_timeout, retcode, errs = execute_cmd(cmd, cmd_params['duration'])
         copy_tree_and_remove_old(counter, dbname)
         counter += 1
 
-        for line in errs.splitlines():
-            if line and not line.startswith('WARNING'):
-                run_had_errors = True
-                print('stderr has error message:')
-                print('***' + line + '***')
+        for line in _STDERR_ERROR_LINE_RE.findall(errs):
+            run_had_errors = True
+            print('stderr has error message:')
+            print('***' + line + '***')
         
         if retcode != 0:
             raise SystemExit('TEST FAILED. See kill option and exit code above!!!\n')
 
         time.sleep(2)  # time to stabilize before the next run
 
-    shutil.rmtree(dbname, True)
-    for ctr in range(max(0, counter - 2), counter):
-        shutil.rmtree('{}_{}'.format(dbname, ctr), True)
+    remove_db_and_last_copies(dbname, counter)
 
 
 # This script runs and kills db_stress multiple times. It checks consistency
@@ -972,9 +1286,11 @@ def narrow_crash_main(args, unknown_args):
 def blackbox_crash_main(args, unknown_args):
     cmd_params = gen_cmd_params(args)
     dbname = get_dbname("blackbox")
-    exit_time = time.time() + cmd_params["duration"]
+    exit_time = time.monotonic() + cmd_params["duration"]
 
     store_ops_supplied(cmd_params)
+    cmd_params["db"] = dbname
+    sanitize_rules = finalize_static(cmd_params)
 
     print(
         "Running blackbox-crash-test with \n"
@@ -988,37 +1304,28 @@ def blackbox_crash_main(args, unknown_args):
 
     counter = 0
 
-    while time.time() < exit_time:
+    while time.monotonic() < exit_time:
         randomize_operation_type_percentages(cmd_params)
-        cmd = gen_cmd(
-            dict(list(cmd_params.items()) + list({"db": dbname}.items())), unknown_args, counter
-        )
+        cmd = gen_cmd(cmd_params, unknown_args, counter, sanitize_rules)
 
-        hit_timeout, retcode, outs, errs = execute_cmd(cmd, cmd_params["interval"])
+        hit_timeout, retcode, errs = execute_cmd(cmd, cmd_params["interval"])
         copy_tree_and_remove_old(counter, dbname)
         counter+=1
 
         if not hit_timeout:
             print("Exit Before Killing")
-            print("stdout:")
-            print(outs)
             print("stderr:")
             print(errs)
             sys.exit(2)
 
-        for line in errs.split("\n"):
-            if line != "" and not line.startswith("WARNING"):
-                print("stderr has error message:")
-                print("***" + line + "***")
-
-        time.sleep(1)  # time to stabilize before the next run
+        for line in _STDERR_ERROR_LINE_RE.findall(errs):
+            print("stderr has error message:")
+            print("***" + line + "***")
 
         time.sleep(1)  # time to stabilize before the next run
 
     # we need to clean up after ourselves -- only do this on test success
-    shutil.rmtree(dbname, True)
-    for ctr in range(max(0, counter - 2), counter):
-        shutil.rmtree('{}_{}'.format(dbname, ctr), True)
+    remove_db_and_last_copies(dbname, counter)
 
 
 # This python script runs db_stress multiple times. Some runs with
@@ -1027,11 +1334,15 @@ def whitebox_crash_main(args, unknown_args):
     cmd_params = gen_cmd_params(args)
     dbname = get_dbname("whitebox")
 
-    cur_time = time.time()
+    # Deadlines use the monotonic clock so that wall clock adjustments do not
+    # cut the test short or make it overrun.
+    cur_time = time.monotonic()
     exit_time = cur_time + cmd_params["duration"]
     half_time = cur_time + cmd_params["duration"] // 2
 
     store_ops_supplied(cmd_params)
+    cmd_params["db"] = dbname
+    sanitize_rules = finalize_static(cmd_params, _WHITEBOX_RUN_PARAMS)
     
     print(
         "Running whitebox-crash-test with \n"
@@ -1046,7 +1357,7 @@ def whitebox_crash_main(args, unknown_args):
     kill_mode = 0
     prev_compaction_style = -1
     counter = 0
-    while time.time() < exit_time:
+    while time.monotonic() < exit_time:
         if cmd_params["disable_kill_points"]:
             check_mode = 3
         if check_mode == 0:
@@ -1099,7 +1410,7 @@ def whitebox_crash_main(args, unknown_args):
             }
             # Single level universal has a lot of special logic. Ensure we cover
             # it sometimes.
-            if random.randint(0, 1) == 1:
+            if random.getrandbits(1):
                 additional_opts.update(
                     {
                         "num_levels": 1,
@@ -1127,14 +1438,18 @@ def whitebox_crash_main(args, unknown_args):
             additional_opts["destroy_db_initially"] = 1
         prev_compaction_style = cur_compaction_style
 
+        unlisted_opts = additional_opts.keys() - _WHITEBOX_RUN_PARAMS
+        if unlisted_opts:
+            raise ValueError(
+                "Error - %s must be in _WHITEBOX_RUN_PARAMS"
+                % ", ".join(sorted(unlisted_opts))
+            )
         randomize_operation_type_percentages(cmd_params)
         cmd = gen_cmd(
-            dict(
-                list(cmd_params.items())
-                + list(additional_opts.items())
-                + list({"db": dbname}.items())
-            ),
-            unknown_args, counter
+            {**cmd_params, **additional_opts},
+            unknown_args,
+            counter,
+            sanitize_rules,
         )
 
         # If the running time is 15 minutes over the run time, explicit kill and
@@ -1143,15 +1458,14 @@ def whitebox_crash_main(args, unknown_args):
         # for job scheduling or execution.
         # TODO detect a hanging condition. The job might run too long as RocksDB
         # hits a hanging bug.
-        hit_timeout, retncode, stdoutdata, stderrdata = execute_cmd(
-            cmd, exit_time - time.time() + 900
+        hit_timeout, retncode, stderrdata = execute_cmd(
+            cmd, exit_time - time.monotonic() + 900
         )
         msg = "check_mode={0}, kill option={1}, exitcode={2}\n".format(
             check_mode, additional_opts["kill_random_test"], retncode
         )
 
         print(msg)
-        print(stdoutdata)
         print(stderrdata)
         
         copy_tree_and_remove_old(counter, dbname)
@@ -1187,13 +1501,12 @@ def whitebox_crash_main(args, unknown_args):
 
         # First half of the duration, keep doing kill test. For the next half,
         # try different modes.
-        if time.time() > half_time:
+        if time.monotonic() > half_time:
             # we need to clean up after ourselves -- only do this on test
             # success
             shutil.rmtree(dbname, True)
-            if cleanup_cmd is not None:
-                print("Running DB cleanup command - %s\n" % cleanup_cmd)
-                ret = os.system(cleanup_cmd)
+            if cleanup_cmd:
+                ret = run_cleanup_cmd()
                 if ret != 0:
                     print("TEST FAILED. DB cleanup returned error %d\n" % ret)
                     sys.exit(1)
@@ -1207,17 +1520,20 @@ def whitebox_crash_main(args, unknown_args):
 
         time.sleep(1)  # time to stabilize after a kill
 
-    for ctr in range(max(0, counter - 2), counter):
-        shutil.rmtree('{}_{}'.format(dbname, ctr), True)
+    remove_db_and_last_copies(dbname, counter, with_db=False)
+
+
+_BOOL_MAP = {
+    'false': False, '0': False, 'no': False,
+    'true': True, '1': True, 'yes': True,
+}
 
 
 def bool_converter(v):
-    s = v.lower().strip()
-    if s in ('false', '0', 'no'):
-        return False
-    elif s in ('true', '1', 'yes'):
-        return True
-    raise ValueError('Failed to parse `%s` as a boolean value' % v)
+    b = _BOOL_MAP.get(v.lower().strip())
+    if b is None:
+        raise ValueError('Failed to parse `%s` as a boolean value' % v)
+    return b
 
 
 def main():
@@ -1240,27 +1556,7 @@ def main():
     parser.add_argument("--test_tiered_storage", action="store_true")
     parser.add_argument("--cleanup_cmd")
 
-    all_params = dict(
-        list(default_params.items())
-        + list(blackbox_default_params.items())
-        + list(whitebox_default_params.items())
-        + list(simple_default_params.items())
-        + list(blackbox_simple_default_params.items())
-        + list(whitebox_simple_default_params.items())
-        + list(blob_params.items())
-        + list(ts_params.items())
-        + list(supplied_ops.items())
-        + list(narrow_params.items())
-        + list(multiops_txn_default_params.items())
-        + list(multiops_wc_txn_params.items())
-        + list(multiops_wp_txn_params.items())
-        + list(best_efforts_recovery_params.items())
-        + list(cf_consistency_params.items())
-        + list(tiered_params.items())
-        + list(txn_params.items())
-    )
-
-    for k, v in all_params.items():
+    for k, v in _ALL_PARAMS.items():
         t = type(v() if callable(v) else v)
         if t is bool:
             t = bool_converter